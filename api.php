@@ -4,6 +4,7 @@
 session_start(); // Start a new or resume the existing session for tracking user state
 require_once __DIR__ . '/vendor/autoload.php'; // Autoload dependencies (e.g., Dotenv, Guzzle, etc.)
 require_once __DIR__ . '/embedding_utils.php'; // Include utility functions for embedding calculations
+require_once __DIR__ . '/retrieval_cache.php'; // Include the retrieval result cache
 
 
 /**
@@ -105,7 +106,7 @@ header('Access-Control-Allow-Methods: POST, OPTIONS');
 header('Access-Control-Allow-Headers: Content-Type, Authorization');
 
 // --- Enhanced API Request Logging ---
-function log_api_request($input, $finalSystemPrompt, $finalUserPrompt, $startDate = null, $endDate = null) {
+function log_api_request($input, $finalSystemPrompt, $finalUserPrompt, $startDate = null, $endDate = null, $retrievalCache = null) {
     $logFile = __DIR__ . '/api_requests.log';
     $timestamp = date('c');
     $clientIp = $_SERVER['REMOTE_ADDR'] ?? 'unknown';
@@ -137,6 +138,7 @@ function log_api_request($input, $finalSystemPrompt, $finalUserPrompt, $startDat
         'final_user_prompt' => $finalUserPrompt,
         'start_date' => $startDate,
         'end_date' => $endDate,
+        'retrieval_cache' => $retrievalCache,
     ];
     // Append the log entry as a JSON line to the log file
     file_put_contents($logFile, json_encode($logEntry, JSON_UNESCAPED_UNICODE) . PHP_EOL, FILE_APPEND);
@@ -164,6 +166,14 @@ $top_n_chunks = 20;           // Number of top relevant chunks to use
 $similarityThreshold = 0.5;   // Minimum similarity for chunk inclusion
 $maxContextTokens = 100000;    // Approximate context limit
 
+// Retrieval Cache Configuration
+$useRetrievalCache = true;         // Cache selected chunks per (query, date range, index version)
+$retrievalCacheTtl = 3600;         // Seconds a cached retrieval result stays valid
+$retrievalCacheMaxEntries = 200;   // Maximum cached results per knowledge base (LRU eviction)
+$retrievalCacheSimilarity = 0.98;  // Minimum query embedding similarity for a near-duplicate hit
+$retrievalCacheSignatureBits = 8;  // Bits of the SimHash query embedding signature
+$retrievalCacheBucketSize = 8;     // Cached queries compared per signature bucket
+
 // HTTP Method Check
 if ($_SERVER['REQUEST_METHOD'] === 'OPTIONS') {
     // Handle CORS preflight
@@ -181,6 +191,7 @@ if ($_SERVER['REQUEST_METHOD'] !== 'POST') {
 // Read the JSON input from the request body and extract the user prompt
 $input = json_decode(file_get_contents('php://input'), true);
 $prompt = trim($input['prompt'] ?? '');
+$userQuery = $prompt; // Keep the original question (without the time prefix) for the retrieval cache
 
 /*
 * Date Parser LLM Call
@@ -226,9 +237,40 @@ if ($allChunksData === null || !is_array($allChunksData)) {
    $allChunksData = [];
 }
 
+// Retrieval Cache Lookup by Normalized Query
+// On a hit, both the query embedding and the similarity search are skipped
+$relevantChunks = [];
+$retrievalCacheHit = false;
+$retrievalCacheDir = null;
+$retrievalCacheOutcome = 'miss';
+$retrievalCacheSavedMs = 0.0;
+$retrievalCacheHitKey = null;
+$retrievalCacheNewEntry = null;
+$retrievalCacheParams = [$startDate, $endDate, $top_n_chunks, $similarityThreshold];
+if ($useRetrievalCache && !empty($allChunksData)) {
+    $retrievalCacheDir = retrieval_cache_dir($chunksFile);
+    $retrievalCacheVersion = retrieval_cache_index_version($chunksFile);
+    $retrievalCacheIndex = retrieval_cache_read_index($retrievalCacheDir, $retrievalCacheVersion);
+    $retrievalCacheKey = retrieval_cache_key(array_merge(['query', retrieval_cache_normalize_query($userQuery)], $retrievalCacheParams));
+    $cachedEntry = retrieval_cache_get($retrievalCacheDir, $retrievalCacheIndex, $retrievalCacheKey, $retrievalCacheTtl);
+    if ($cachedEntry !== null) {
+        $cachedChunks = retrieval_cache_restore_chunks($cachedEntry, $allChunksData);
+        if ($cachedChunks !== null) {
+            $relevantChunks = $cachedChunks;
+            $retrievalCacheHit = true;
+            $retrievalCacheOutcome = 'text_hit';
+            $retrievalCacheSavedMs = $cachedEntry['embed_ms'] + $cachedEntry['retrieval_ms'];
+            $retrievalCacheHitKey = $cachedEntry['key'];
+        }
+    }
+}
+
 // Get Embedding for User Query
 $queryEmbedding = null;
-if ($usePythonEmbedding) {
+$embedStart = microtime(true);
+if ($retrievalCacheHit) {
+    // Relevant chunks come from the retrieval cache, no query embedding needed
+} elseif ($usePythonEmbedding) {
     // Use a Python script to generate the embedding for the user query
     $escapedPrompt = escapeshellarg($prompt);
     $cmd = "python " . escapeshellarg($pythonEmbeddingScript) . " $escapedPrompt";
@@ -283,11 +325,32 @@ if ($usePythonEmbedding) {
         error_log("Embedding API error: " . $e->getMessage());
     }
 }
+$embedMs = (microtime(true) - $embedStart) * 1000;
+
+// Retrieval Cache Lookup by Quantized Query Embedding (near-duplicate questions)
+if ($retrievalCacheDir !== null && !$retrievalCacheHit && $queryEmbedding !== null) {
+    $retrievalCacheBucketKey = retrieval_cache_key(array_merge(
+        ['embedding', retrieval_cache_embedding_signature($queryEmbedding, $retrievalCacheSignatureBits)],
+        $retrievalCacheParams
+    ));
+    $cachedEntry = retrieval_cache_find_similar($retrievalCacheDir, $retrievalCacheIndex, $retrievalCacheBucketKey, $queryEmbedding, $retrievalCacheSimilarity, $retrievalCacheTtl);
+    if ($cachedEntry !== null) {
+        $cachedChunks = retrieval_cache_restore_chunks($cachedEntry, $allChunksData);
+        if ($cachedChunks !== null) {
+            $relevantChunks = $cachedChunks;
+            $retrievalCacheHit = true;
+            $retrievalCacheOutcome = 'embedding_hit';
+            $retrievalCacheSavedMs = $cachedEntry['retrieval_ms'];
+            $retrievalCacheHitKey = $cachedEntry['key'];
+        }
+    }
+}
 
 // Find Relevant Chunks by Similarity
-$relevantChunks = [];
-if ($queryEmbedding !== null && !empty($allChunksData)) {
+$retrievalStart = microtime(true);
+if (!$retrievalCacheHit && $queryEmbedding !== null && !empty($allChunksData)) {
    $filteredChunksData = $allChunksData;
+   $filteredPositions = array_keys($allChunksData); // Position of each filtered chunk in $allChunksData
 
    // --- Filter Chunks by Date Range FIRST ---
    // If a date range was extracted, filter chunks to only those within the range
@@ -301,6 +364,7 @@ if ($queryEmbedding !== null && !empty($allChunksData)) {
            return true;
        });
        // Re-index array to avoid gaps in keys
+       $filteredPositions = array_keys($filteredChunksData);
        $filteredChunksData = array_values($filteredChunksData);
    }
 
@@ -311,14 +375,7 @@ if ($queryEmbedding !== null && !empty($allChunksData)) {
        if (isset($chunk['embedding']) && is_array($chunk['embedding'])) {
            $similarity = cosineSimilarity($queryEmbedding, $chunk['embedding']);
            if ($similarity !== false && $similarity >= $similarityThreshold) {
-               $chunkScores[] = [
-                   'index' => $index,
-                   'score' => $similarity,
-                   'text' => $chunk['text'],
-                   'title' => $chunk['original_article_title'] ?? '',
-                   'url' => $chunk['original_article_url'] ?? '',
-                   'image_url' => $chunk['image_url'] ?? ''
-               ];
+               $chunkScores[] = build_relevant_chunk($chunk, $index, $filteredPositions[$index], $similarity);
            }
        }
    }
@@ -328,6 +385,31 @@ if ($queryEmbedding !== null && !empty($allChunksData)) {
    });
    // Take the top N most relevant chunks for context
    $relevantChunks = array_slice($chunkScores, 0, $top_n_chunks);
+
+   // Prepare the result for the retrieval cache
+   if ($retrievalCacheDir !== null) {
+       $retrievalCacheNewEntry = [
+           'key' => $retrievalCacheKey,
+           'bucket_key' => $retrievalCacheBucketKey,
+           'embedding' => $queryEmbedding,
+           'chunks' => $relevantChunks,
+           'embed_ms' => $embedMs,
+           'retrieval_ms' => (microtime(true) - $retrievalStart) * 1000,
+       ];
+   }
+}
+
+// Update the retrieval cache and report hit rates and latency saved
+$retrievalCacheSummary = null;
+if ($retrievalCacheDir !== null) {
+   $retrievalCacheIndex = retrieval_cache_commit(
+       $retrievalCacheDir, $retrievalCacheVersion, $retrievalCacheOutcome, $retrievalCacheSavedMs,
+       $retrievalCacheHitKey, $retrievalCacheNewEntry, $retrievalCacheTtl, $retrievalCacheMaxEntries,
+       $retrievalCacheBucketSize
+   );
+   $retrievalCacheSummary = retrieval_cache_stats_summary($retrievalCacheIndex);
+   $retrievalCacheSummary['hit'] = $retrievalCacheHit;
+   error_log("Retrieval cache: " . json_encode($retrievalCacheSummary));
 }
 
 // Build Context String for LLM
@@ -380,7 +462,7 @@ else {
 // Compose User Prompt with Context
 
 // Log the incoming API request, including the final system and user prompts (after all augmentation/context is applied)
-log_api_request($input, $systemPrompt, $userPromptAugmented, $startDate, $endDate);
+log_api_request($input, $systemPrompt, $userPromptAugmented, $startDate, $endDate, $retrievalCacheSummary);
 
 // Compose Messages for OpenAI Chat API
 // Prepare the messages array for the OpenAI Chat API call
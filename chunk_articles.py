@@ -0,0 +1,346 @@
+"""
+Tokenizer-aware chunking script for articles with OCR and file extraction data.
+
+Python counterpart of chunk_articles.php. Instead of splitting by paragraphs,
+it packs sentences into chunks sized by the retromae tokenizer, counting the
+same metadata prefix that generate_embeddings.py prepends before embedding,
+so chunks are no longer silently truncated at MAX_LENGTH tokens.
+"""
+import json
+import os
+import re
+import statistics
+import sys
+
+from transformers import AutoTokenizer
+
+# --- Configuration ---
+MODEL_NAME = "Seznam/retromae-small-cs"  # Use the same model as generate_embeddings.py
+INPUT_JSON_FILE = "tatce_articles_with_extracted_text_retry_8.json"
+OUTPUT_JSON_FILE = "chunks_tokenized.json"
+MAX_LENGTH = 512        # Model window, must match MAX_LENGTH in generate_embeddings.py
+TARGET_TOKENS = 384     # Target size of a chunk including the metadata prefix
+OVERLAP_TOKENS = 48     # Tokens of trailing sentences repeated at the start of the next chunk
+MIN_CHUNK_TOKENS = 64   # Chunks whose text (without prefix) is below this size are merged with a neighbour
+BATCH_SIZE = 32         # Batch size used by generate_embeddings.py (for padded compute estimate)
+
+# Source fields of an article, in the order chunk_articles.php processes them
+SOURCE_CONTENT = "content"
+SOURCE_IMAGE_OCR = "image_ocr"
+SOURCE_FILE_EXTRACTION = "file_extraction"
+
+# Sentence end followed by an uppercase letter, so dates like "8. 4. 2025" stay in one piece
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+(?=[A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ„\"])")
+
+
+def build_embedding_text(chunk):
+    """
+    Build the exact string generate_embeddings.py feeds to the model:
+    url | title | date | source_type | text. Empty fields are skipped, but
+    like generate_embeddings.py a None value is embedded as "None".
+    """
+    fields = [
+        chunk.get("original_article_url", ""),
+        chunk.get("original_article_title", ""),
+        chunk.get("original_article_date", ""),
+        chunk.get("source_type", ""),
+        chunk.get("text", ""),
+    ]
+    return " | ".join([str(f).strip() for f in fields if str(f).strip() != ""])
+
+
+def count_tokens(tokenizer, text):
+    """Number of tokens (including special tokens) the model sees for text, before truncation."""
+    return len(tokenizer(text, add_special_tokens=True, truncation=False)["input_ids"])
+
+
+def split_sentences(text):
+    """
+    Split text into sentence-like units. Lines are kept as separate units
+    (OCR and extracted text rarely use punctuation), then each line is split
+    on sentence-ending punctuation.
+    """
+    cleaned = text.replace("\r\n", "\n").strip()
+    units = []
+    for line in cleaned.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        units.extend(s.strip() for s in SENTENCE_SPLIT_RE.split(line) if s.strip())
+    return units
+
+
+def split_oversized_unit(tokenizer, unit, budget):
+    """Split a single unit that exceeds the token budget into word groups that fit."""
+    parts = []
+    current = []
+    for word in unit.split():
+        candidate = " ".join(current + [word])
+        if current and count_tokens(tokenizer, candidate) > budget:
+            parts.append(" ".join(current))
+            current = [word]
+        else:
+            current.append(word)
+    if current:
+        parts.append(" ".join(current))
+    return parts
+
+
+def pack_units(tokenizer, units, meta, target_tokens, overlap_tokens):
+    """
+    Greedily pack sentence units into texts whose full embedding string
+    (metadata prefix + text) stays within target_tokens.
+    The last units of a chunk, up to overlap_tokens, are repeated at the
+    start of the following chunk.
+    """
+    def fits(candidate_units):
+        return count_tokens(tokenizer, build_embedding_text({**meta, "text": "\n".join(candidate_units)})) <= target_tokens
+
+    # Budget available for the text alone, used to break up oversized units
+    prefix_tokens = count_tokens(tokenizer, build_embedding_text({**meta, "text": "x"})) - 1
+    text_budget = max(target_tokens - prefix_tokens, 1)
+
+    expanded = []
+    for unit in units:
+        if fits([unit]):
+            expanded.append(unit)
+        else:
+            expanded.extend(split_oversized_unit(tokenizer, unit, text_budget))
+
+    texts = []
+    current = []
+    fresh = 0  # Units in current that are not overlap from the previous chunk
+    for unit in expanded:
+        if current and not fits(current + [unit]):
+            if fresh:
+                texts.append("\n".join(current))
+            # Carry trailing units into the next chunk as overlap
+            overlap = []
+            for prev in reversed(current):
+                if count_tokens(tokenizer, "\n".join([prev] + overlap)) > overlap_tokens:
+                    break
+                overlap.insert(0, prev)
+            current = overlap
+            fresh = 0
+            # Drop overlap if it leaves no room for the new unit
+            while current and not fits(current + [unit]):
+                current.pop(0)
+        current.append(unit)
+        fresh += 1
+    if current and fresh:
+        texts.append("\n".join(current))
+    return texts
+
+
+def article_segments(article):
+    """
+    Yield (metadata, text) for every text source of an article, using the
+    same fields, source types and OCR-error skipping as chunk_articles.php.
+    """
+    base = {
+        "original_article_url": article.get("url") or "unknown_url",
+        "original_article_title": article.get("title") or "unknown_title",
+        "original_article_date": article.get("date"),
+    }
+    if article.get("content"):
+        yield {**base, "source_type": SOURCE_CONTENT}, article["content"]
+
+    for image_ocr in article.get("images_ocr_text") or []:
+        if image_ocr.get("ocr_text"):
+            meta = {**base, "source_type": SOURCE_IMAGE_OCR, "image_url": image_ocr.get("image_url")}
+            yield meta, image_ocr["ocr_text"]
+
+    for file_text in article.get("files_extracted_text") or []:
+        extracted = file_text.get("extracted_text")
+        if not extracted:
+            continue
+        # Skip chunks that are just OCR errors
+        if extracted.startswith("OCR Error:"):
+            print(f"Warning: Skipping OCR Error chunk from: {base['original_article_url']}")
+            continue
+        meta = {
+            **base,
+            "source_type": SOURCE_FILE_EXTRACTION,
+            "file_url": file_text.get("file_url"),
+            "link_text": file_text.get("link_text"),
+        }
+        yield meta, extracted
+
+
+def merge_chunks(first, second):
+    """
+    Merge two chunks of the same article into one, keeping all extra metadata.
+    The first chunk's source_type is kept (it is part of the embedded prefix);
+    all merged source types are listed in merged_source_types.
+    """
+    merged = dict(first)
+    source_types = first.get("merged_source_types", [first["source_type"]])
+    for source_type in second.get("merged_source_types", [second["source_type"]]):
+        if source_type not in source_types:
+            source_types = source_types + [source_type]
+    if len(source_types) > 1:
+        merged["merged_source_types"] = source_types
+    for key, value in second.items():
+        if merged.get(key) is None and value is not None:
+            merged[key] = value
+    merged["text"] = first["text"] + "\n\n" + second["text"]
+    return merged
+
+
+def merge_undersized(tokenizer, chunks, min_tokens, max_tokens):
+    """
+    Merge chunks of one article whose text (without the metadata prefix) is
+    smaller than min_tokens into the previous (or else the next) chunk, as
+    long as the full embedding string stays within max_tokens.
+    """
+    merged = list(chunks)
+    i = 0
+    while i < len(merged):
+        chunk = merged[i]
+        if count_tokens(tokenizer, chunk["text"]) >= min_tokens or len(merged) == 1:
+            i += 1
+            continue
+        # Prefer merging into the previous chunk, so the text order stays intact
+        for j in (i - 1, i + 1):
+            if 0 <= j < len(merged):
+                first, second = (merged[j], chunk) if j < i else (chunk, merged[j])
+                candidate = merge_chunks(first, second)
+                if count_tokens(tokenizer, build_embedding_text(candidate)) <= max_tokens:
+                    merged[min(i, j)] = candidate
+                    del merged[max(i, j)]
+                    i = min(i, j)
+                    break
+        else:
+            i += 1
+    return merged
+
+
+def chunk_article(tokenizer, article):
+    """Split one article into token-sized chunks (without chunk_id)."""
+    chunks = []
+    for meta, text in article_segments(article):
+        units = split_sentences(text)
+        for chunk_text in pack_units(tokenizer, units, meta, TARGET_TOKENS, OVERLAP_TOKENS):
+            chunks.append({**meta, "text": chunk_text})
+    return merge_undersized(tokenizer, chunks, MIN_CHUNK_TOKENS, TARGET_TOKENS)
+
+
+def legacy_chunk_article(article):
+    """Split one article by paragraphs, exactly like chunk_articles.php (used as the baseline)."""
+    chunks = []
+    for meta, text in article_segments(article):
+        cleaned = text.replace("\r\n", "\n").strip()
+        if not cleaned:
+            continue
+        for paragraph in re.split(r"\n{2,}", cleaned):
+            chunks.append({**meta, "text": paragraph.strip()})
+    return chunks
+
+
+def chunk_statistics(tokenizer, chunks, max_length=MAX_LENGTH, batch_size=BATCH_SIZE):
+    """
+    Token statistics of chunks as generate_embeddings.py would embed them:
+    tokens-per-chunk distribution, truncation rate and embedding compute
+    (tokens actually processed, and tokens including batch padding).
+    """
+    lengths = [count_tokens(tokenizer, build_embedding_text(c)) for c in chunks]
+    if not lengths:
+        return None
+    embedded = [min(n, max_length) for n in lengths]
+    padded_tokens = sum(
+        max(embedded[i:i + batch_size]) * len(embedded[i:i + batch_size])
+        for i in range(0, len(embedded), batch_size)
+    )
+    truncated = sum(1 for n in lengths if n > max_length)
+    deciles = statistics.quantiles(lengths, n=10) if len(lengths) > 1 else [lengths[0]] * 9
+    return {
+        "chunks": len(lengths),
+        "min": min(lengths),
+        "p50": statistics.median(lengths),
+        "p90": deciles[8],
+        "max": max(lengths),
+        "mean": statistics.mean(lengths),
+        "truncated": truncated,
+        "truncation_rate": truncated / len(lengths),
+        "tokens_lost": sum(lengths) - sum(embedded),
+        "forward_passes": len(lengths),
+        "embedded_tokens": sum(embedded),
+        "padded_tokens": padded_tokens,
+    }
+
+
+def print_statistics(label, stats):
+    """Print the statistics returned by chunk_statistics."""
+    print(f"\n--- {label} ---")
+    if stats is None:
+        print("No chunks.")
+        return
+    print(f"Chunks (forward passes): {stats['chunks']}")
+    print(
+        f"Tokens per chunk: min {stats['min']}, p50 {stats['p50']:.0f}, "
+        f"p90 {stats['p90']:.0f}, max {stats['max']}, mean {stats['mean']:.1f}"
+    )
+    print(
+        f"Truncated at {MAX_LENGTH} tokens: {stats['truncated']} "
+        f"({stats['truncation_rate']:.1%}), tokens lost: {stats['tokens_lost']}"
+    )
+    print(f"Embedded tokens: {stats['embedded_tokens']}")
+    print(f"Padded tokens (batch size {BATCH_SIZE}): {stats['padded_tokens']}")
+
+
+def main():
+    if OVERLAP_TOKENS >= TARGET_TOKENS or TARGET_TOKENS > MAX_LENGTH:
+        print("Error: expected OVERLAP_TOKENS < TARGET_TOKENS <= MAX_LENGTH.")
+        sys.exit(1)
+
+    if not os.path.exists(INPUT_JSON_FILE):
+        print(f"Error: Input JSON file not found at {INPUT_JSON_FILE}")
+        sys.exit(1)
+
+    try:
+        with open(INPUT_JSON_FILE, "r", encoding="utf-8") as f:
+            articles = json.load(f)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON from {INPUT_JSON_FILE}: {e}")
+        sys.exit(1)
+
+    try:
+        print(f"Loading tokenizer: {MODEL_NAME}...")
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    except Exception as e:
+        print(f"Error loading tokenizer: {e}")
+        sys.exit(1)
+
+    all_chunks = []
+    legacy_chunks = []
+    for article in articles:
+        legacy_chunks.extend(legacy_chunk_article(article))
+        for chunk in chunk_article(tokenizer, article):
+            # Keep the chunk_id format and key order of chunk_articles.php
+            chunk_id = f"chunk_{len(all_chunks) + 1:06d}"
+            all_chunks.append({"chunk_id": chunk_id, **chunk})
+
+    try:
+        with open(OUTPUT_JSON_FILE, "w", encoding="utf-8") as f:
+            json.dump(all_chunks, f, ensure_ascii=False, indent=4)
+    except IOError as e:
+        print(f"Error writing chunked data to output file {OUTPUT_JSON_FILE}: {e}")
+        sys.exit(1)
+
+    print(f"Successfully created chunked data in: {OUTPUT_JSON_FILE}")
+    print(f"Total chunks created: {len(all_chunks)}")
+
+    before = chunk_statistics(tokenizer, legacy_chunks)
+    after = chunk_statistics(tokenizer, all_chunks)
+    print_statistics("Before (paragraph chunks, chunk_articles.php)", before)
+    print_statistics(f"After (token chunks, target {TARGET_TOKENS}, overlap {OVERLAP_TOKENS})", after)
+
+    if before and after:
+        print("\n--- Embedding compute ---")
+        for key in ("forward_passes", "embedded_tokens", "padded_tokens"):
+            change = (after[key] - before[key]) / before[key] if before[key] else 0.0
+            print(f"{key}: {before[key]} -> {after[key]} ({change:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 <?php
-//embedding_utils.php - Utility functions for vector operations (e.g., cosine similarity)
+//embedding_utils.php - Utility functions for vector operations (e.g., cosine similarity) and relevant chunk rows
 /**
  * Calculates the cosine similarity between two vectors (arrays of numbers).
  *
@@ -45,4 +45,27 @@ function cosineSimilarity(array $vecA, array $vecB): float|false
     // Return the cosine similarity score (between -1 and 1)
     return $dotProduct / $magnitude;
 }
+
+/**
+ * Builds the row of a relevant chunk used for the LLM context (and stored by the retrieval cache).
+ *
+ * @param array $chunk Chunk from the knowledge base.
+ * @param int $index Position of the chunk in the date-filtered chunk list.
+ * @param int $position Position of the chunk in the whole knowledge base.
+ * @param float $score Cosine similarity to the query embedding.
+ * @return array Relevant chunk row.
+ */
+function build_relevant_chunk(array $chunk, int $index, int $position, float $score): array
+{
+    return [
+        'index' => $index,
+        'position' => $position,
+        'chunk_id' => $chunk['chunk_id'] ?? null,
+        'score' => $score,
+        'text' => $chunk['text'],
+        'title' => $chunk['original_article_title'] ?? '',
+        'url' => $chunk['original_article_url'] ?? '',
+        'image_url' => $chunk['image_url'] ?? ''
+    ];
+}
 ?>
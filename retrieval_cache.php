@@ -0,0 +1,474 @@
+<?php
+//retrieval_cache.php - File-based cache of retrieval results (selected chunks and scores) for api.php
+/**
+ * The cache maps a normalized query (or, for near-duplicate questions, a quantized
+ * query embedding signature) plus the resolved date range to the selected chunk IDs
+ * and scores. Each knowledge base file has its own cache directory, stamped with an
+ * index version; when the chunks file is regenerated the stamp changes and the cache is reset.
+ *
+ * Cache directory layout:
+ *   index.json        small index rewritten once per request:
+ *                     [
+ *                       'index_version' => string,
+ *                       'entries' => [key => ['created', 'last_used', 'bucket', 'embed_ms', 'retrieval_ms']],
+ *                       'buckets' => [bucketKey => [key, ...]] (most recent last),
+ *                       'stats' => ['text_hits', 'embedding_hits', 'misses', 'saved_ms', 'evictions', 'invalidations'],
+ *                     ]
+ *   entry_<key>.json  one file per entry: ['embedding' => [...], 'chunks' => [['position', 'index', 'chunk_id', 'score'], ...]],
+ *                     written once
+ *   index.lock        held for the read-modify-write of index.json
+ *
+ * All files are written to a temporary file and renamed into place, so readers
+ * never see a partially written file and lookups need no lock.
+ */
+
+/**
+ * Returns a version stamp of the knowledge base file, which changes whenever the file is rewritten.
+ *
+ * @param string $chunksFile Path to the chunks-with-embeddings JSON file.
+ * @return string Version stamp.
+ */
+function retrieval_cache_index_version(string $chunksFile): string
+{
+    clearstatcache(true, $chunksFile);
+    $mtime = @filemtime($chunksFile);
+    $size = @filesize($chunksFile);
+    return sha1($chunksFile . '|' . var_export($mtime, true) . '|' . var_export($size, true));
+}
+
+/**
+ * Returns the cache directory for a knowledge base file (temp dir, writable on Vercel as well).
+ *
+ * @param string $chunksFile Path to the chunks-with-embeddings JSON file.
+ * @return string Path to the cache directory.
+ */
+function retrieval_cache_dir(string $chunksFile): string
+{
+    return sys_get_temp_dir() . '/tatce_retrieval_cache_' . md5($chunksFile);
+}
+
+/**
+ * Normalizes query text so trivially different questions share a cache entry
+ * (case, whitespace and trailing punctuation are ignored).
+ *
+ * @param string $query Raw user question.
+ * @return string Normalized query.
+ */
+function retrieval_cache_normalize_query(string $query): string
+{
+    $query = mb_strtolower(trim($query), 'UTF-8');
+    $query = preg_replace('/\s+/u', ' ', $query);
+    return rtrim($query, " \t\n\r\0\x0B.,!?;:");
+}
+
+/**
+ * Returns $bits random hyperplanes (Gaussian normal vectors) of the given dimension.
+ * The generator is seeded, so every request gets the same hyperplanes.
+ *
+ * @param int $dimensions Embedding dimension.
+ * @param int $bits Number of hyperplanes.
+ * @param int $seed Random seed.
+ * @return array List of normal vectors.
+ */
+function retrieval_cache_hyperplanes(int $dimensions, int $bits, int $seed): array
+{
+    static $hyperplanes = [];
+    $cacheKey = "$dimensions:$bits:$seed";
+    if (!isset($hyperplanes[$cacheKey])) {
+        mt_srand($seed);
+        $planes = [];
+        for ($b = 0; $b < $bits; $b++) {
+            $plane = [];
+            for ($d = 0; $d < $dimensions; $d++) {
+                // Box-Muller transform of two uniform samples
+                $u1 = (mt_rand() + 1) / (mt_getrandmax() + 1);
+                $u2 = mt_rand() / mt_getrandmax();
+                $plane[] = sqrt(-2 * log($u1)) * cos(2 * M_PI * $u2);
+            }
+            $planes[] = $plane;
+        }
+        mt_srand(); // Reseed randomly so other mt_rand() users are not affected
+        $hyperplanes[$cacheKey] = $planes;
+    }
+    return $hyperplanes[$cacheKey];
+}
+
+/**
+ * Quantizes an embedding into a SimHash signature: each bit is the side of a
+ * seeded random hyperplane the embedding falls on. Two embeddings at angle
+ * theta differ in each bit with probability theta / pi, so near-duplicate
+ * queries usually land in the same bucket.
+ *
+ * @param array $embedding Query embedding.
+ * @param int $bits Number of signature bits.
+ * @param int $seed Random seed of the hyperplanes.
+ * @return string Signature as a string of '0' and '1'.
+ */
+function retrieval_cache_embedding_signature(array $embedding, int $bits = 8, int $seed = 20250412): string
+{
+    $embedding = array_values($embedding);
+    $signature = '';
+    foreach (retrieval_cache_hyperplanes(count($embedding), $bits, $seed) as $plane) {
+        $dotProduct = 0.0;
+        foreach ($plane as $d => $weight) {
+            $dotProduct += $weight * $embedding[$d];
+        }
+        $signature .= $dotProduct >= 0 ? '1' : '0';
+    }
+    return $signature;
+}
+
+/**
+ * Builds a cache key from its parts (query or signature, date range, retrieval settings).
+ *
+ * @param array $parts Values the retrieval result depends on.
+ * @return string Cache key.
+ */
+function retrieval_cache_key(array $parts): string
+{
+    return sha1(json_encode($parts, JSON_UNESCAPED_UNICODE));
+}
+
+/**
+ * Returns an empty cache index.
+ *
+ * @param string|null $indexVersion Version stamp of the knowledge base.
+ * @return array Cache index.
+ */
+function retrieval_cache_empty_index(?string $indexVersion): array
+{
+    return [
+        'index_version' => $indexVersion,
+        'entries' => [],
+        'buckets' => [],
+        'stats' => [
+            'text_hits' => 0,
+            'embedding_hits' => 0,
+            'misses' => 0,
+            'saved_ms' => 0.0,
+            'evictions' => 0,
+            'invalidations' => 0,
+        ],
+    ];
+}
+
+/**
+ * Writes JSON data to a temporary file in the same directory and renames it over $path.
+ *
+ * @param string $path Target file.
+ * @param array $data Data to encode.
+ * @return bool True on success.
+ */
+function retrieval_cache_write_json(string $path, array $data): bool
+{
+    $tmpFile = @tempnam(dirname($path), 'tmp_');
+    if ($tmpFile === false || @file_put_contents($tmpFile, json_encode($data)) === false || !@rename($tmpFile, $path)) {
+        if ($tmpFile !== false) {
+            @unlink($tmpFile);
+        }
+        error_log("Retrieval cache: failed to write $path");
+        return false;
+    }
+    return true;
+}
+
+/**
+ * Reads the cache index as stored on disk.
+ *
+ * @param string $cacheDir Cache directory.
+ * @return array Cache index (empty, with a null version, if missing or unreadable).
+ */
+function retrieval_cache_load_index_file(string $cacheDir): array
+{
+    $index = json_decode((string)@file_get_contents($cacheDir . '/index.json'), true);
+    if (!is_array($index) || !isset($index['entries'], $index['buckets'], $index['stats'])) {
+        return retrieval_cache_empty_index(null);
+    }
+    return $index;
+}
+
+/**
+ * Reads the cache index for lookups. An index stamped with another version
+ * (the knowledge base was regenerated) is treated as empty.
+ *
+ * @param string $cacheDir Cache directory.
+ * @param string $indexVersion Current version stamp of the knowledge base.
+ * @return array Cache index.
+ */
+function retrieval_cache_read_index(string $cacheDir, string $indexVersion): array
+{
+    $index = retrieval_cache_load_index_file($cacheDir);
+    if ($index['index_version'] !== $indexVersion) {
+        return retrieval_cache_empty_index($indexVersion);
+    }
+    return $index;
+}
+
+/**
+ * Returns the path of the file holding one cache entry.
+ *
+ * @param string $cacheDir Cache directory.
+ * @param string $key Cache key.
+ * @return string Path to the entry file.
+ */
+function retrieval_cache_entry_file(string $cacheDir, string $key): string
+{
+    return $cacheDir . '/entry_' . $key . '.json';
+}
+
+/**
+ * Returns a live entry by key (index metadata merged with the entry file), or null
+ * if it is missing or older than the TTL.
+ *
+ * @param string $cacheDir Cache directory.
+ * @param array $index Cache index.
+ * @param string $key Cache key.
+ * @param int $ttl Time to live in seconds.
+ * @return array|null Cache entry or null on miss.
+ */
+function retrieval_cache_get(string $cacheDir, array $index, string $key, int $ttl): ?array
+{
+    if (!isset($index['entries'][$key]) || time() - $index['entries'][$key]['created'] > $ttl) {
+        return null;
+    }
+    $data = json_decode((string)@file_get_contents(retrieval_cache_entry_file($cacheDir, $key)), true);
+    if (!is_array($data) || !isset($data['embedding'], $data['chunks'])) {
+        return null;
+    }
+    return array_merge($index['entries'][$key], $data, ['key' => $key]);
+}
+
+/**
+ * Looks up a near-duplicate query: all entries in the same signature bucket are
+ * compared with the query embedding and the most similar one is used, if it is
+ * at least $minSimilarity similar.
+ *
+ * @param string $cacheDir Cache directory.
+ * @param array $index Cache index.
+ * @param string $bucketKey Key built from the embedding signature.
+ * @param array $embedding Query embedding.
+ * @param float $minSimilarity Minimum cosine similarity of the two query embeddings.
+ * @param int $ttl Time to live in seconds.
+ * @return array|null Cache entry or null on miss.
+ */
+function retrieval_cache_find_similar(string $cacheDir, array $index, string $bucketKey, array $embedding, float $minSimilarity, int $ttl): ?array
+{
+    $bestEntry = null;
+    $bestSimilarity = $minSimilarity;
+    foreach ((array)($index['buckets'][$bucketKey] ?? []) as $key) {
+        $entry = retrieval_cache_get($cacheDir, $index, (string)$key, $ttl);
+        if ($entry === null) {
+            continue;
+        }
+        $similarity = cosineSimilarity($embedding, $entry['embedding']);
+        if ($similarity !== false && $similarity >= $bestSimilarity) {
+            $bestEntry = $entry;
+            $bestSimilarity = $similarity;
+        }
+    }
+    return $bestEntry;
+}
+
+/**
+ * Removes an entry from the index and deletes its file.
+ *
+ * @param array &$index Cache index.
+ * @param string $cacheDir Cache directory.
+ * @param string $key Cache key.
+ * @return void
+ */
+function retrieval_cache_remove_entry(array &$index, string $cacheDir, string $key): void
+{
+    unset($index['entries'][$key]);
+    foreach ($index['buckets'] as $bucketKey => $keys) {
+        $keys = array_values(array_filter((array)$keys, function ($entryKey) use ($key) {
+            return (string)$entryKey !== $key;
+        }));
+        if ($keys) {
+            $index['buckets'][$bucketKey] = $keys;
+        } else {
+            unset($index['buckets'][$bucketKey]);
+        }
+    }
+    @unlink(retrieval_cache_entry_file($cacheDir, $key));
+}
+
+/**
+ * Records the outcome of a request in the cache, holding the index lock for the
+ * whole read-modify-write so concurrent requests do not lose each other's updates.
+ * Drops expired entries, touches the entry that was hit, stores a new entry
+ * (evicting the least recently used ones above $maxEntries) and updates the stats.
+ *
+ * @param string $cacheDir Cache directory.
+ * @param string $indexVersion Current version stamp of the knowledge base.
+ * @param string $outcome Lookup outcome: 'text_hit', 'embedding_hit' or 'miss'.
+ * @param float $savedMs Milliseconds saved by the hit (0 for a miss).
+ * @param string|null $hitKey Key of the entry that was hit.
+ * @param array|null $newEntry Entry to store: ['key', 'bucket_key', 'embedding', 'chunks', 'embed_ms', 'retrieval_ms'],
+ *                             where 'chunks' are rows from build_relevant_chunk.
+ * @param int $ttl Time to live in seconds.
+ * @param int $maxEntries Maximum number of entries.
+ * @param int $bucketSize Maximum number of entries kept per signature bucket.
+ * @return array Updated cache index.
+ */
+function retrieval_cache_commit(string $cacheDir, string $indexVersion, string $outcome, float $savedMs, ?string $hitKey, ?array $newEntry, int $ttl, int $maxEntries, int $bucketSize): array
+{
+    if (!is_dir($cacheDir) && !@mkdir($cacheDir, 0777, true) && !is_dir($cacheDir)) {
+        error_log("Retrieval cache: failed to create cache directory $cacheDir");
+        return retrieval_cache_empty_index($indexVersion);
+    }
+    $lock = @fopen($cacheDir . '/index.lock', 'c');
+    if ($lock === false || !flock($lock, LOCK_EX)) {
+        error_log("Retrieval cache: failed to lock cache directory $cacheDir");
+        return retrieval_cache_empty_index($indexVersion);
+    }
+
+    try {
+        $index = retrieval_cache_load_index_file($cacheDir);
+        if ($index['index_version'] !== $indexVersion) {
+            // New index: results selected from the old one are no longer valid
+            foreach (glob($cacheDir . '/entry_*.json') ?: [] as $entryFile) {
+                @unlink($entryFile);
+            }
+            if ($index['index_version'] !== null) {
+                $index['stats']['invalidations']++;
+            }
+            $index['index_version'] = $indexVersion;
+            $index['entries'] = [];
+            $index['buckets'] = [];
+        }
+
+        $now = time();
+        foreach ($index['entries'] as $key => $meta) {
+            if ($now - $meta['created'] > $ttl) {
+                retrieval_cache_remove_entry($index, $cacheDir, (string)$key);
+            }
+        }
+
+        if ($hitKey !== null && isset($index['entries'][$hitKey])) {
+            $index['entries'][$hitKey]['last_used'] = $now;
+        }
+
+        if ($newEntry !== null) {
+            retrieval_cache_store_entry($index, $cacheDir, $newEntry, $now, $maxEntries, $bucketSize);
+        }
+
+        $statKey = $outcome === 'miss' ? 'misses' : $outcome . 's';
+        $index['stats'][$statKey]++;
+        $index['stats']['saved_ms'] += $savedMs;
+
+        retrieval_cache_write_json($cacheDir . '/index.json', $index);
+        return $index;
+    } finally {
+        flock($lock, LOCK_UN);
+        fclose($lock);
+    }
+}
+
+/**
+ * Writes a new entry file and adds it to the index, evicting the least recently
+ * used entries above $maxEntries. Results with chunks lacking a chunk_id are not cached.
+ *
+ * @param array &$index Cache index.
+ * @param string $cacheDir Cache directory.
+ * @param array $newEntry Entry to store (see retrieval_cache_commit).
+ * @param int $now Current timestamp.
+ * @param int $maxEntries Maximum number of entries.
+ * @param int $bucketSize Maximum number of entries kept per signature bucket.
+ * @return void
+ */
+function retrieval_cache_store_entry(array &$index, string $cacheDir, array $newEntry, int $now, int $maxEntries, int $bucketSize): void
+{
+    $chunks = [];
+    foreach ($newEntry['chunks'] as $chunk) {
+        if (!isset($chunk['chunk_id'])) {
+            return;
+        }
+        $chunks[] = [
+            'position' => $chunk['position'],
+            'index' => $chunk['index'],
+            'chunk_id' => $chunk['chunk_id'],
+            'score' => $chunk['score'],
+        ];
+    }
+
+    $key = $newEntry['key'];
+    $data = [
+        // Rounded to keep the entry file small, precise enough for the similarity check
+        'embedding' => array_map(fn($v) => round((float)$v, 5), $newEntry['embedding']),
+        'chunks' => $chunks,
+    ];
+    if (!retrieval_cache_write_json(retrieval_cache_entry_file($cacheDir, $key), $data)) {
+        return;
+    }
+    $index['entries'][$key] = [
+        'created' => $now,
+        'last_used' => $now,
+        'bucket' => $newEntry['bucket_key'],
+        'embed_ms' => $newEntry['embed_ms'],
+        'retrieval_ms' => $newEntry['retrieval_ms'],
+    ];
+    // Keep the most recent entries of the bucket; older ones stay reachable by query text
+    $bucket = array_values(array_filter((array)($index['buckets'][$newEntry['bucket_key']] ?? []), function ($entryKey) use ($key) {
+        return (string)$entryKey !== $key;
+    }));
+    $bucket[] = $key;
+    $index['buckets'][$newEntry['bucket_key']] = array_slice($bucket, -$bucketSize);
+
+    // Evict least recently used entries over the size bound
+    if (count($index['entries']) > $maxEntries) {
+        uasort($index['entries'], function ($a, $b) {
+            return $a['last_used'] <=> $b['last_used'];
+        });
+        foreach (array_slice(array_keys($index['entries']), 0, count($index['entries']) - $maxEntries) as $evictedKey) {
+            retrieval_cache_remove_entry($index, $cacheDir, (string)$evictedKey);
+            $index['stats']['evictions']++;
+        }
+    }
+}
+
+/**
+ * Rebuilds the relevant chunks (see build_relevant_chunk) from a cache entry,
+ * looking chunks up by their cached position in the knowledge base.
+ *
+ * @param array $entry Cache entry.
+ * @param array $allChunksData Loaded knowledge base.
+ * @return array|null Relevant chunks, or null if a cached position no longer holds the cached chunk_id.
+ */
+function retrieval_cache_restore_chunks(array $entry, array $allChunksData): ?array
+{
+    $relevantChunks = [];
+    foreach ($entry['chunks'] as $cached) {
+        $chunk = $allChunksData[$cached['position'] ?? -1] ?? null;
+        if (!is_array($chunk) || ($chunk['chunk_id'] ?? null) !== $cached['chunk_id']) {
+            return null;
+        }
+        $relevantChunks[] = build_relevant_chunk($chunk, $cached['index'], $cached['position'], $cached['score']);
+    }
+    return $relevantChunks;
+}
+
+/**
+ * Summarizes cache statistics (hit rates and latency saved) for logging.
+ *
+ * @param array $index Cache index.
+ * @return array Summary.
+ */
+function retrieval_cache_stats_summary(array $index): array
+{
+    $stats = $index['stats'];
+    $hits = $stats['text_hits'] + $stats['embedding_hits'];
+    $lookups = $hits + $stats['misses'];
+    return [
+        'entries' => count($index['entries']),
+        'lookups' => $lookups,
+        'hit_rate' => $lookups > 0 ? round($hits / $lookups, 4) : 0.0,
+        'text_hit_rate' => $lookups > 0 ? round($stats['text_hits'] / $lookups, 4) : 0.0,
+        'embedding_hit_rate' => $lookups > 0 ? round($stats['embedding_hits'] / $lookups, 4) : 0.0,
+        'saved_ms' => round($stats['saved_ms'], 1),
+        'avg_saved_ms_per_hit' => $hits > 0 ? round($stats['saved_ms'] / $hits, 1) : 0.0,
+        'evictions' => $stats['evictions'],
+        'invalidations' => $stats['invalidations'],
+    ];
+}
+?>